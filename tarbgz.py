@@ -1,4 +1,4 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python3
 
 """
 tarbgz.py: random access TAR files compressed with BGZF and external indexing.
@@ -8,9 +8,11 @@ Usage examples:
     tar cf example.tar demo
     bgzip example.tar
     ./tarbgz.py example.tar.gz example.tar.gz.index --index
+    ./tarbgz.py example.tar.gz example.tar.gz.index --index --jobs 4
     ./tarbgz.py example.tar.gz example.tar.gz.index --find ""
     ./tarbgz.py example.tar.gz example.tar.gz.index --find "demo"
     ./tarbgz.py example.tar.gz example.tar.gz.index --extract "demo/test.c"
+    ./tarbgz.py example.tar.gz example.tar.gz.index --extract-list files.txt
 
 """
 
@@ -19,25 +21,52 @@ import os
 import sys
 import logging
 
-from Bio import bgzf
 import tarfile
-import pickle
-import shutil
+import struct
+import mmap
+import bisect
+import multiprocessing
+import zlib
+import array
+
+# Packed index files start with this magic number and the number of entries
+INDEX_MAGIC = b"TARBGZ\x00\x01"
+INDEX_HEADER = struct.Struct("<8sQ")
+# Then come u32 offsets for the paths, and u64 fields for each IndexEntry, as
+# array/memoryview type codes.
+INDEX_OFFSET_TYPE = "I"
+INDEX_RECORD_TYPE = "Q"
+
+# Tar header types that just modify the header after them
+TAR_EXTENSION_TYPES = (tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK,
+    tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.SOLARIS_XHDTYPE)
+# Tar header types that never have data after them, whatever their sizes say
+TAR_TYPES_WITHOUT_DATA = (tarfile.LNKTYPE, tarfile.SYMTYPE, tarfile.CHRTYPE,
+    tarfile.BLKTYPE, tarfile.DIRTYPE, tarfile.FIFOTYPE)
 
 class BgzfWrapper(object):
     """
-    File-like object to wrap a Bio.bgzf BgzfReader, with ordinary
+    File-like object to wrap a FastBgzfReader, with ordinary
     non-virtual-offset-based forward-only seek() and tell().
     
+    Reads whole BGZF blocks into a buffer, so that the many small reads of tar
+    headers are not each passed on to the reader. Only the blocks a read needs
+    are decompressed, so data after it can still be skipped without
+    decompressing it.
+    
     """
     
+    # Read ahead at least this many decompressed bytes when we don't know how
+    # much will be wanted
+    BUFFER_SIZE = 1 << 20
+    
     def __init__(self, reader, initial_offset=0):
         """
-        Wrap the given BgzfReader.
+        Wrap the given FastBgzfReader.
         
-        If the BgzfReader is not at the start of the file, initial_offset must
+        If the reader is not at the start of the file, initial_offset must
         be set to the offset in the compressed data corresponding to the
-        virtual offset that the BgzfReader is at (to allow absolute seek
+        virtual offset that the reader is at (to allow absolute seek
         forward from there, as is used by tarfile).
         
         """
@@ -48,17 +77,65 @@ class BgzfWrapper(object):
         # Track offset
         self.offset = initial_offset
         
+        # Hold data read ahead from the reader, and our position in it
+        self.buffer = bytearray()
+        self.buffer_pos = 0
+        
+        # Remember the buffer position at which each block's data starts, and
+        # the virtual offset that corresponds to, so we can still work out
+        # virtual offsets for data in the buffer.
+        self.block_starts = []
+        self.block_virtual_offsets = []
+        
+    def fill(self, size=None):
+        """
+        Read ahead whole blocks from the reader until at least the given number
+        of bytes (or BUFFER_SIZE) have been added, or to EOF.
+        Return False if there was nothing left to read.
+        """
+        
+        if size is None:
+            size = self.BUFFER_SIZE
+        
+        if self.buffer_pos > 0:
+            # Drop what we have already read, but keep the block we are in
+            del self.buffer[:self.buffer_pos]
+            keep = max(bisect.bisect_right(self.block_starts, self.buffer_pos) - 1, 0)
+            self.block_starts = [start - self.buffer_pos for start in self.block_starts[keep:]]
+            self.block_virtual_offsets = self.block_virtual_offsets[keep:]
+            self.buffer_pos = 0
+        
+        added = 0
+        while added < size:
+            virtual_offset, data = self.reader.read_block()
+            if len(data) == 0:
+                # We hit EOF
+                break
+            self.block_starts.append(len(self.buffer))
+            self.block_virtual_offsets.append(virtual_offset)
+            self.buffer += data
+            added += len(data)
+            
+        return added > 0
+        
     def read(self, size=-1):
         """
         Read the given number of bytes, or whatever is available.
-        Note that reading whatever is available isn't actually implemented and will fail.
         
         """
         
-        bytes_read = self.reader.read(size)
+        while size < 0 or len(self.buffer) - self.buffer_pos < size:
+            # Only read ahead as far as we need to
+            wanted = None if size < 0 else size - (len(self.buffer) - self.buffer_pos)
+            if not self.fill(wanted):
+                break
+        
+        end = len(self.buffer) if size < 0 else self.buffer_pos + size
+        bytes_read = bytes(self.buffer[self.buffer_pos:end])
+        self.buffer_pos += len(bytes_read)
         self.offset += len(bytes_read)
         
-        logging.info("Read {} to {} in compressed stream".format(len(bytes_read), self.offset))
+        logging.debug("Read %d to %d in compressed stream", len(bytes_read), self.offset)
         
         return bytes_read
         
@@ -67,13 +144,38 @@ class BgzfWrapper(object):
         Read a single line.
         """
         
-        line = self.reader.readline()
+        # Find the end of the line, reading ahead until we have it
+        searched = self.buffer_pos
+        line_end = self.buffer.find(b"\n", searched)
+        while line_end == -1:
+            searched = len(self.buffer) - self.buffer_pos
+            if not self.fill():
+                # The last line has no newline
+                line_end = len(self.buffer) - 1
+                break
+            line_end = self.buffer.find(b"\n", searched)
+        
+        line = bytes(self.buffer[self.buffer_pos:line_end + 1])
+        self.buffer_pos += len(line)
         self.offset += len(line)
         
-        logging.info("Read {} to {} in compressed stream".format(len(line), self.offset))
+        logging.debug("Read %d to %d in compressed stream", len(line), self.offset)
         
         return line
         
+    def virtual_tell(self):
+        """
+        Report the BGZF virtual offset of the current position.
+        """
+        
+        if self.buffer_pos == len(self.buffer):
+            # Nothing is read ahead, so the reader is where we are
+            return self.reader.tell()
+            
+        # Find the block we are in, and offset into it
+        i = bisect.bisect_right(self.block_starts, self.buffer_pos) - 1
+        return self.block_virtual_offsets[i] + (self.buffer_pos - self.block_starts[i])
+        
     def tell(self):
         """
         Report the current offset from the file start.
@@ -92,16 +194,199 @@ class BgzfWrapper(object):
         # And we can't seek backward
         assert(distance >= 0)
         
-        logging.info("Seek ahead {} from {} in compressed stream".format(distance, self.offset))
+        logging.debug("Seek ahead %d from %d in compressed stream", distance, self.offset)
+        
+        self.skip(distance)
+        
+    def skip(self, size):
+        """
+        Skip forward the given number of bytes, or to EOF, without copying out
+        the data skipped over.
+        """
+        
+        # Use up what we have read ahead first
+        from_buffer = min(size, len(self.buffer) - self.buffer_pos)
+        self.buffer_pos += from_buffer
+        self.offset += from_buffer
+        
+        if size > from_buffer:
+            # The buffer is used up, so the reader is where we are. Let it skip
+            # the rest, which it can do without decompressing whole blocks.
+            self.offset += self.reader.skip(size - from_buffer)
+        
+class FastBgzfReader(object):
+    """
+    Reader for BGZF files, with the same virtual-offset-based seek() and tell()
+    as a Bio.bgzf BgzfReader.
+    
+    Memory maps the compressed file and inflates each BGZF block in one zlib
+    call, and hands out whole blocks with read_block(), so bulk reads don't
+    have to go through Bio.bgzf's Python-level block handling.
+    
+    """
+    
+    def __init__(self, filename):
+        """
+        Open the given BGZF file, at the start.
+        """
+        
+        with open(filename, "rb") as compressed_file:
+            # The map stays valid after the file is closed
+            self.data = mmap.mmap(compressed_file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        # Keep the compressed start and size of the current block, its
+        # decompressed data, and our position in that.
+        self.block_start = None
+        self.block_size = 0
+        self.block = b""
+        self.within_block = 0
+        
+        self.load_block(0)
         
-        while distance > 0:
-            dist_read = len(self.read(distance))
-            distance -= dist_read
+    def load_block(self, start):
+        """
+        Decompress the block starting at the given compressed offset, and move
+        to its start. At EOF, the block is empty and has size 0.
+        """
+        
+        self.within_block = 0
+        if start == self.block_start:
+            # Already loaded
+            return
+        
+        self.block_start = start
+        if start >= len(self.data):
+            # We hit EOF
+            self.block_size = 0
+            self.block = b""
+            return
             
-            if dist_read == 0:
+        self.block_size, data_start = parse_bgzf_header(self.data, start)
+        block_end = start + self.block_size
+        
+        # The deflated data is followed by the CRC32 and data size
+        self.block = zlib.decompress(self.data[data_start:block_end - 8], -15)
+        crc, data_size = struct.unpack_from("<II", self.data, block_end - 8)
+        if data_size != len(self.block) or crc != zlib.crc32(self.block):
+            raise RuntimeError("Corrupt BGZF block at offset {}".format(start))
+            
+    def read_block(self):
+        """
+        Read the rest of the current BGZF block, or the next nonempty one if
+        we are at the end of the current one.
+        
+        Returns the virtual offset the data started at, and the data, which is
+        empty at EOF.
+        """
+        
+        while self.block_size and self.within_block == len(self.block):
+            # Move on to the next block
+            self.load_block(self.block_start + self.block_size)
+            
+        virtual_offset = self.tell()
+        data = self.block[self.within_block:] if self.within_block else self.block
+        self.within_block = len(self.block)
+        return virtual_offset, data
+        
+    def skip(self, size):
+        """
+        Skip forward the given number of bytes, or to EOF. Blocks that are
+        skipped entirely are never decompressed, since their sizes are in
+        their trailers.
+        
+        Returns the number of bytes skipped.
+        """
+        
+        # Skip what we can in the current block
+        remaining = size - min(size, len(self.block) - self.within_block)
+        self.within_block += size - remaining
+        
+        start = self.block_start + self.block_size
+        while remaining > 0:
+            if start >= len(self.data):
                 # We hit EOF
+                self.load_block(start)
                 break
                 
+            block_size, _ = parse_bgzf_header(self.data, start)
+            data_size = bgzf_block_data_size(self.data, start, block_size)
+            if data_size <= remaining:
+                # Skip this whole block
+                remaining -= data_size
+                start += block_size
+                if remaining == 0:
+                    # We stop at its end, which is the start of the next one
+                    self.load_block(start)
+            else:
+                # We stop in this block
+                self.load_block(start)
+                self.within_block = remaining
+                remaining = 0
+                
+        return size - remaining
+        
+    def tell(self):
+        """
+        Return the BGZF virtual offset of the current position.
+        """
+        
+        if self.within_block > 0 and self.within_block == len(self.block):
+            # At the end of a block, report the start of the next one, like
+            # Bio.bgzf does.
+            return (self.block_start + self.block_size) << 16
+        return (self.block_start << 16) | self.within_block
+        
+    def seek(self, virtual_offset):
+        """
+        Seek to the given BGZF virtual offset.
+        """
+        
+        self.load_block(virtual_offset >> 16)
+        within_block = virtual_offset & 0xFFFF
+        if within_block > len(self.block):
+            raise RuntimeError("Virtual offset {} is past the end of its block".format(virtual_offset))
+        self.within_block = within_block
+        
+    def close(self):
+        """
+        Close the file.
+        """
+        
+        self.data.close()
+        
+def parse_bgzf_header(data, start):
+    """
+    Parse the header of the BGZF block at the given offset in the given bytes
+    or memory map.
+    
+    Returns the total compressed size of the block, and the offset its deflated
+    data starts at.
+    """
+    
+    if data[start:start + 4] != b"\x1f\x8b\x08\x04":
+        raise RuntimeError("No BGZF block at offset {}".format(start))
+        
+    # Find the BC extra subfield holding the block size
+    extra_length = struct.unpack_from("<H", data, start + 10)[0]
+    extra_end = start + 12 + extra_length
+    i = start + 12
+    while i + 4 <= extra_end:
+        field_id, field_length = struct.unpack_from("<2sH", data, i)
+        if field_id == b"BC" and field_length == 2:
+            return struct.unpack_from("<H", data, i + 4)[0] + 1, extra_end
+        i += 4 + field_length
+        
+    raise RuntimeError("No BGZF block size at offset {}".format(start))
+    
+def bgzf_block_data_size(data, start, block_size):
+    """
+    Return the decompressed size of the BGZF block with the given compressed
+    start and size in the given bytes or memory map, without decompressing it.
+    """
+    
+    # The decompressed size is the last 4 bytes of the block
+    return struct.unpack_from("<I", data, start + block_size - 4)[0]
+    
 class IndexEntry(object):
     """
     Entry for a file in the index.
@@ -111,6 +396,10 @@ class IndexEntry(object):
 
     """
     
+    # There is one of these per file in the archive, so don't give each one a
+    # __dict__.
+    __slots__ = ("virtual_offset", "real_offset", "size", "next_virtual_offset")
+    
     def __init__(self, virtual_offset, real_offset, size, next_virtual_offset):
         """
         Make a new entry with the given virtual and real offsets and file size.
@@ -129,94 +418,155 @@ class IndexEntry(object):
         
         return "IndexEntry({}, {}, {}, {})".format(self.virtual_offset, self.real_offset, self.size, self.next_virtual_offset)
         
-class IndexNode:
+class Index(object):
     """
-    Node in the index tree.
+    Builds an index of an archive, for saving. Holds IndexEntry objects by
+    path.
     
-    Holds a dict of children, and also possibly an IndexEntry for the directory or file it represents.
+    Only used when writing an index; saved indexes are queried with
+    PackedIndex.
     """
     
-    def __init__(self, children=None, entry=None):
-        """
-        Make a new IndexNode with the given children and entry (defaulting to empty).
+    def __init__(self):
         """
-        
-        self.children = {} if children is None else children
-        self.entry = entry
-        
-    def has_child(self, name):
-        """
-        Return true if we have a child node with the given name, and false otherwise.
+        Make a new, empty index.
         """
         
-        return self.children.has_key(name)
+        # We store the whole index flat, keyed by normalized path ("a/b/c"),
+        # instead of as a tree of per-component node objects.
+        # This maps from path to IndexEntry
+        self.entries = {}
         
-    def make_child(self, name):
+    def insert(self, path, entry):
         """
-        Create a new child of this node under the given name.
-        Overwrites any existing child.
+        Insert a file or directory into the index at the given path,
+        with the given IndexEntry holding its metadata.
         """
         
-        self.children[name] = IndexNode()
+        # Store the entry under its normalized path. Saving sorts the paths,
+        # so no directory tree needs to be kept here.
+        self.entries["/".join(Index.atomize_path(path))] = entry
         
-    def get_child(self, name):
+    def save(self, filename):
         """
-        Get the child with the given name, or throw an error if no such child exists.
+        Save the index to the given file in the packed binary format that
+        PackedIndex reads.
         """
         
-        return self.children[name]
+        # Sort the paths by their encoded bytes, since that is the order
+        # PackedIndex will binary search in.
+        items = sorted((encode_path(path), entry) for path, entry in self.entries.items())
+        
+        # Lay out the path bytes and the offset table pointing into them.
+        # There is one extra offset at the end so every path has an end.
+        offsets = array.array(INDEX_OFFSET_TYPE, [0])
+        for path_bytes, _ in items:
+            offsets.append(offsets[-1] + len(path_bytes))
+        # Pad the paths so the records start 8-byte aligned
+        padding = -(INDEX_HEADER.size + offsets.itemsize * len(offsets) + offsets[-1]) % 8
+        
+        # Fill in all the record fields in one flat array
+        records = array.array(INDEX_RECORD_TYPE)
+        for _, entry in items:
+            records.extend((entry.virtual_offset, entry.real_offset, entry.size,
+                entry.next_virtual_offset))
+        
+        if sys.byteorder != "little":
+            # The file is little-endian
+            offsets.byteswap()
+            records.byteswap()
+        
+        with open(filename, "wb") as out:
+            out.write(INDEX_HEADER.pack(INDEX_MAGIC, len(items)))
+            offsets.tofile(out)
+            out.write(b"".join(path_bytes for path_bytes, _ in items))
+            out.write(b"\0" * padding)
+            records.tofile(out)
         
-    def get_children(self):
+    def __repr__(self):
         """
-        Return an iterator over all child names.
+        Represent this index as a string.
         """
         
-        return self.children.iterkeys()
+        return "Index({})".format(self.entries)
         
-    def __repr__(self):
+    
+    @staticmethod            
+    def atomize_path(path):
         """
-        Represent this node as a string.
+        Split a path into a list of its non-empty path components.
         """
         
-        return "IndexNode({}, {})".format(self.children, self.entry)
-        
+        # One split does what walking up with os.path.split used to, and
+        # dropping the empty pieces handles leading, trailing, and doubled
+        # slashes.
+        return [part for part in path.replace(os.sep, "/").split("/") if part != ""]
+    
+    
 
 
-class Index(object):
+class PackedIndex(object):
     """
-    Represents an index of an archive. Holds IndexEntry objects in a
-    hierarchical filesystem.
-    """            
+    Read-only view of an index saved with Index.save. The file is memory
+    mapped and binary searched, so nothing is deserialized beyond the few
+    paths and records a query actually touches.
     
-    def __init__(self, root = None):
+    The file holds a header with a magic number and the entry count N, then
+    N + 1 little-endian u32 offsets into a blob of UTF-8 paths sorted by their
+    bytes, then padding to 8 bytes, then N fixed-width records of
+    (virtual_offset, real_offset, size, next_virtual_offset) as u64s. The
+    offsets and records are used as typed arrays directly over the map.
+    """
+    
+    def __init__(self, filename):
         """
-        Make a new, empty index.
+        Open the index saved in the given file.
+        """
+        
+        with open(filename, "rb") as index_file:
+            # The map stays valid after the file is closed
+            self.data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            
+        magic, self.count = INDEX_HEADER.unpack_from(self.data, 0)
+        if magic != INDEX_MAGIC:
+            raise RuntimeError("{} is not a tarbgz index".format(filename))
+            
+        # View the offset table and records as arrays of numbers, straight
+        # out of the map, and find the paths in between.
+        self.offsets = map_array(INDEX_OFFSET_TYPE, self.data, INDEX_HEADER.size, self.count + 1)
+        self.paths_start = INDEX_HEADER.size + self.offsets.itemsize * (self.count + 1)
+        records_start = self.paths_start + self.offsets[self.count]
+        records_start += -records_start % 8
+        # Each record has 4 fields
+        self.records = map_array(INDEX_RECORD_TYPE, self.data, records_start, 4 * self.count)
+        
+        # Sequence of encoded paths, for bisect
+        self.keys = PackedKeys(self)
+        
+    def path_bytes(self, i):
+        """
+        Get the encoded path of the entry with the given index.
         """
         
-        # We store the whole index as a tree of IndexNodes
-        self.root = root if root is not None else IndexNode()
+        return self.data[self.paths_start + self.offsets[i]:self.paths_start + self.offsets[i + 1]]
         
-    def insert(self, path, entry):
+    def entry(self, i):
         """
-        Insert a file or directory into the index at the given path,
-        with the given IndexEntry holding its metadata.
+        Get the IndexEntry with the given index.
         """
         
-        # Get all the parts of the path
-        parts = Index.atomize_path(path)
+        return IndexEntry(*self.records[4 * i:4 * i + 4])
         
-        directory = self.root
+    def get(self, path):
+        """
+        Return the index entry for the given path, or None if the path has no entry or does not exist.
+        """
         
-        for part in parts:
-            if not directory.has_child(part):
-                # Make sure all the parent directories exist, although they may not have IndexEntries yet.
-                directory.make_child(part)
-            # Advance into the thing we are looking for
-            directory = directory.get_child(part)
-            
-        # Now the "directory" is the file or directory we are indexing.
-        # Set its index entry
-        directory.entry = entry
+        key = encode_path("/".join(Index.atomize_path(path)))
+        i = bisect.bisect_left(self.keys, key)
+        if i < self.count and self.keys[i] == key:
+            return self.entry(i)
+        return None
         
     def readdir(self, path):
         """
@@ -225,70 +575,476 @@ class Index(object):
         Use "" to look in the root.
         """
         
-        # Get all the parts of the path
-        parts = Index.atomize_path(path)
-        
-        directory = self.root
+        key = encode_path("/".join(Index.atomize_path(path)))
         
-        for part in parts:
-            if not directory.has_child(part):
-                raise RuntimeError("{} not found".format(part))
-            # Advance into the thing we are looking for
-            directory = directory.get_child(part)
+        if key == b"":
+            # Everything is under the root
+            prefix = b""
+            first, last = 0, self.count
+        else:
+            # Everything under the directory sorts between "dir/" and "dir0",
+            # since "0" is the character after "/".
+            prefix = key + b"/"
+            first = bisect.bisect_left(self.keys, prefix)
+            last = bisect.bisect_left(self.keys, key + b"0", first)
             
-        return directory.get_children()
+            if first == last and self.get(path) is None:
+                raise RuntimeError("{} not found".format(path))
+                
+        return self.list_children(prefix, first, last)
         
-    def get(self, path):
+    def list_children(self, prefix, first, last):
         """
-        Return the index entry for the given path, or None if the path has no entry or does not exist.
+        Yield the distinct names directly under the given encoded directory
+        prefix, from the paths in the given range of entries.
         """
         
-        # Get all the parts of the path
-        parts = Index.atomize_path(path)
-        
-        directory = self.root
-        
-        for part in parts:
-            if not directory.has_child(part):
-                return None
-            # Advance into the thing we are looking for
-            directory = directory.get_child(part)
-            
-        return directory.entry
-        
+        seen = set()
+        i = first
+        while i < last:
+            # Take the first component after the prefix
+            name, slash, _ = self.keys[i][len(prefix):].partition(b"/")
+            if name not in seen:
+                seen.add(name)
+                yield decode_path(name)
+                
+            if slash:
+                # Everything under this child sorts between "child/" and
+                # "child0", so jump over its whole subtree at once instead of
+                # walking it. This is what collapsing chains of single
+                # children in a trie would buy us.
+                i = bisect.bisect_left(self.keys, prefix + name + b"0", i + 1, last)
+            else:
+                i += 1
+                
     def __repr__(self):
         """
         Represent this index as a string.
         """
         
-        return "Index({})".format(self.root)
+        return "PackedIndex({} entries)".format(self.count)
         
+class PackedKeys(object):
+    """
+    Sequence of the encoded paths in a PackedIndex, in sorted order.
+    """
     
-    @staticmethod            
-    def atomize_path(path):
+    def __init__(self, packed_index):
         """
-        Split a path with os.path.split into a list of path components.
+        Make a sequence over the paths in the given PackedIndex.
         """
         
-        # Split off the last path component
-        (head, tail) = os.path.split(path)
+        self.packed_index = packed_index
         
-        if head != "":
-            # Recurse on the head
-            parts = Index.atomize_path(head)
-        else:
-            # This was just a zero- or one-component path
-            parts = []
+    def __len__(self):
+        """
+        Return the number of paths.
+        """
         
-        if tail != "":
-            # This was not a 0-component path
-            parts.append(tail)
-            
-        return parts
+        return self.packed_index.count
+        
+    def __getitem__(self, i):
+        """
+        Return the encoded path at the given index.
+        """
+        
+        return self.packed_index.path_bytes(i)
+        
+def map_array(type_code, data, start, count):
+    """
+    Get a sequence of the given number of little-endian numbers of the given
+    array type code, from the given offset in the given bytes or memory map.
+    
+    On little-endian machines this is a view of the data without any copying.
+    """
     
+    view = memoryview(data)[start:start + array.array(type_code).itemsize * count]
+    if sys.byteorder == "little":
+        return view.cast(type_code)
+        
+    # Otherwise we need to copy and swap
+    values = array.array(type_code)
+    values.frombytes(view)
+    values.byteswap()
+    return values
+    
+def encode_path(path):
+    """
+    Encode a path string to the bytes stored in a packed index.
+    """
+    
+    # tarfile decodes names with surrogateescape, so round-trip that way
+    return path.encode("utf-8", "surrogateescape")
+    
+def decode_path(path_bytes):
+    """
+    Decode bytes from a packed index back into a path string.
+    """
+    
+    return path_bytes.decode("utf-8", "surrogateescape")
     
 
-
+def parse_tar_number(field):
+    """
+    Parse a numeric field from a tar header, which is either octal text or, for
+    big numbers, base-256 with the high bit of the first byte set.
+    """
+    
+    if field[0] & 0x80:
+        # Base-256. A first byte of all ones marks a negative number.
+        number = int.from_bytes(field[1:], "big")
+        if field[0] == 0xff:
+            number -= 256 ** (len(field) - 1)
+        return number
+    
+    digits = field.split(b"\0", 1)[0].strip()
+    try:
+        return int(digits, 8) if digits else 0
+    except ValueError:
+        raise tarfile.InvalidHeaderError("invalid number field")
+        
+def parse_tar_header(block):
+    """
+    Parse a 512-byte tar header block.
+    
+    Returns the name (as bytes), size, and type flag from the header, or None
+    if the block is all zeros, as at the end of the archive. Raises
+    tarfile.InvalidHeaderError if the checksum is wrong.
+    """
+    
+    if block.count(b"\0") == tarfile.BLOCKSIZE:
+        return None
+        
+    # The checksum is the sum of the header bytes, with the checksum field
+    # itself counted as spaces. Some old tars sum them as signed bytes.
+    checksum = parse_tar_number(block[148:156])
+    if (checksum != sum(block) - sum(block[148:156]) + 256 and
+        checksum != sum(struct.unpack_from("148b8x356b", block)) + 256):
+        raise tarfile.InvalidHeaderError("bad checksum")
+        
+    name = block[:100].split(b"\0", 1)[0]
+    if block[257:263] == b"ustar\0":
+        # POSIX headers can split long names, putting the start in a prefix
+        # field. GNU headers keep other things there.
+        prefix = block[345:500].split(b"\0", 1)[0]
+        if prefix:
+            name = prefix + b"/" + name
+            
+    return name, parse_tar_number(block[124:136]), block[156:157]
+    
+def read_tar_header(wrapper):
+    """
+    Read the header of the next tar member from the given BgzfWrapper,
+    including any GNU long name or pax extended headers that come before it,
+    and leave the wrapper at the start of the member's data.
+    
+    Returns the member's name, size, type flag, and the size of the data
+    actually stored after the header, or None at the end of the archive. The
+    sizes differ only for sparse files, which are reported with the
+    GNUTYPE_SPARSE type flag however they were stored.
+    """
+    
+    # These can be set by extended headers, and override the real header
+    name = None
+    size = None
+    # This is set for sparse files, which may have holes
+    real_size = None
+    
+    while True:
+        block = wrapper.read(tarfile.BLOCKSIZE)
+        if len(block) < tarfile.BLOCKSIZE:
+            # We hit EOF
+            return None
+        header = parse_tar_header(block)
+        if header is None:
+            # We hit the zero blocks at the end
+            return None
+        header_name, header_size, type_flag = header
+        
+        if type_flag == tarfile.GNUTYPE_SPARSE:
+            real_size = parse_tar_number(block[483:495])
+            # Old GNU sparse files can have extra header blocks listing their
+            # pieces, each flagging whether another follows.
+            extended = block[482]
+            while extended:
+                block = wrapper.read(tarfile.BLOCKSIZE)
+                extended = len(block) == tarfile.BLOCKSIZE and block[504]
+                
+        if type_flag not in TAR_EXTENSION_TYPES:
+            # This is the real header
+            if name is None:
+                name = decode_path(header_name)
+            if type_flag in (tarfile.DIRTYPE, tarfile.AREGTYPE) and name.endswith("/"):
+                # Old tars mark directories only with the trailing slash
+                type_flag = tarfile.DIRTYPE
+                name = name.rstrip("/")
+            if size is None:
+                size = header_size
+            if real_size is not None:
+                return name, real_size, tarfile.GNUTYPE_SPARSE, size
+            return name, size, type_flag, size
+            
+        # Extended header data is padded out to whole blocks
+        data = wrapper.read(header_size + (-header_size % tarfile.BLOCKSIZE))[:header_size]
+        
+        if type_flag == tarfile.GNUTYPE_LONGNAME:
+            name = decode_path(data.split(b"\0", 1)[0])
+        elif type_flag in (tarfile.XHDTYPE, tarfile.SOLARIS_XHDTYPE):
+            # Pax records look like "<length> <key>=<value>\n"
+            pos = 0
+            try:
+                while pos < len(data):
+                    space = data.index(b" ", pos)
+                    length = int(data[pos:space])
+                    key, value = data[space + 1:pos + length - 1].split(b"=", 1)
+                    if key in (b"path", b"GNU.sparse.name"):
+                        name = decode_path(value)
+                    elif key == b"size":
+                        size = int(value)
+                    elif key in (b"GNU.sparse.realsize", b"GNU.sparse.size"):
+                        real_size = int(value)
+                    pos += length
+            except ValueError:
+                raise tarfile.InvalidHeaderError("invalid pax header")
+                
+def iter_tar_headers(wrapper):
+    """
+    Iterate over the members of the tar file in the given BgzfWrapper,
+    skipping over their data.
+    
+    Yields the name, size, and type flag of each member, and the (decompressed
+    offset, virtual offset) pairs where its headers start and where the next
+    member starts.
+    """
+    
+    # Each member starts where the last one ended, so we only need to take the
+    # offsets once per member.
+    start = (wrapper.tell(), wrapper.virtual_tell())
+    while True:
+        header = read_tar_header(wrapper)
+        if header is None:
+            return
+        name, size, type_flag, data_size = header
+        
+        if type_flag not in TAR_TYPES_WITHOUT_DATA:
+            # Data is padded out to whole blocks
+            wrapper.skip(data_size + (-data_size % tarfile.BLOCKSIZE))
+            
+        end = (wrapper.tell(), wrapper.virtual_tell())
+        yield name, size, type_flag, start, end
+        start = end
+        
+def index_members(archive_path, start_virtual_offset=0, start_offset=0, end_offset=None):
+    """
+    Index the members of the given BGZF-compressed tar file, starting with the
+    one whose header is at the given virtual offset and decompressed offset.
+    
+    If end_offset is set, stop at the first header at or after that
+    decompressed offset.
+    
+    Returns a list of (path, IndexEntry) pairs, and the (decompressed offset,
+    virtual offset) of the header we stopped at, or None if we hit the end of
+    the archive.
+    """
+    
+    items = []
+    
+    # Open the archive
+    archive_bgzf = FastBgzfReader(archive_path)
+    archive_bgzf.seek(start_virtual_offset)
+    archive_wrapper = BgzfWrapper(archive_bgzf, start_offset)
+    
+    # Parse the headers ourselves. We only need names and sizes, and to know
+    # where each member starts and ends, so tarfile would be overkill.
+    for name, size, type_flag, start, end in iter_tar_headers(archive_wrapper):
+        if end_offset is not None and start[0] >= end_offset:
+            # This member is someone else's job
+            archive_bgzf.close()
+            return items, start
+            
+        logging.debug("Got tar header for %s at offset %d, virtual offset %d", name, start[0], start[1])
+        
+        # Make an IndexEntry for this file, but which knows the virtual offset of the next file
+        # This means it can define a used byte range in the bgzf file for asynchronous retrieval
+        items.append((name, IndexEntry(start[1], start[0], size, end[1])))
+        
+    archive_bgzf.close()
+    return items, None
+    
+def bgzf_blocks(archive_path):
+    """
+    Yield the compressed start offset and decompressed size of each BGZF block
+    in the given file, reading only the block headers and trailers.
+    """
+    
+    with open(archive_path, "rb") as archive_file:
+        data = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+    try:
+        start = 0
+        while start < len(data):
+            block_size, _ = parse_bgzf_header(data, start)
+            data_size = bgzf_block_data_size(data, start, block_size)
+            
+            yield start, data_size
+            start += block_size
+    finally:
+        data.close()
+        
+def index_shard(shard):
+    """
+    Index one shard of an archive, in a worker process.
+    
+    Takes a tuple of the archive path, the virtual and decompressed offsets of
+    the BGZF block the shard starts at, and the decompressed offset where the
+    next shard starts (or None).
+    
+    Since the shard probably starts in the middle of a member, we skip ahead to
+    the first thing that looks like a tar header. If that is really data that
+    just happens to look like one, the parent will notice, since it is not
+    where the previous shard ran up to.
+    
+    Returns the decompressed offset of the header we started at (or None if we
+    found none, or hit a bad header after it), a list of (path,
+    virtual_offset, real_offset, size, next_virtual_offset) tuples, and where
+    we stopped, as for index_members. The results go back to the parent
+    pickled, and plain tuples pickle smaller and load several times faster
+    than IndexEntry objects.
+    """
+    
+    archive_path, virtual_offset, offset, end_offset = shard
+    
+    archive_bgzf = FastBgzfReader(archive_path)
+    archive_bgzf.seek(virtual_offset)
+    archive_wrapper = BgzfWrapper(archive_bgzf, offset)
+    
+    # Tar headers are all block-aligned
+    archive_wrapper.seek(offset + (-offset % tarfile.BLOCKSIZE))
+    
+    while end_offset is None or archive_wrapper.tell() < end_offset:
+        header_offset = archive_wrapper.tell()
+        header_virtual_offset = archive_wrapper.virtual_tell()
+        block = archive_wrapper.read(tarfile.BLOCKSIZE)
+        if len(block) < tarfile.BLOCKSIZE:
+            # We hit EOF
+            break
+        try:
+            # See if the checksum works out
+            if parse_tar_header(block) is None:
+                continue
+        except tarfile.HeaderError:
+            continue
+            
+        archive_bgzf.close()
+        try:
+            items, stop = index_members(archive_path, header_virtual_offset, header_offset, end_offset)
+        except tarfile.TarError:
+            # Either this wasn't really a header, or the archive is broken
+            # further on. Report no start, so the parent can't take this for
+            # the end of the archive, and re-indexes the shard itself, raising
+            # the error if it is real.
+            return None, [], None
+        return header_offset, [(path, entry.virtual_offset, entry.real_offset,
+            entry.size, entry.next_virtual_offset) for path, entry in items], stop
+        
+    archive_bgzf.close()
+    return None, [], None
+    
+def index_parallel(archive_path, jobs):
+    """
+    Index the members of the given BGZF-compressed tar file using the given
+    number of processes, each taking a range of BGZF blocks.
+    
+    Returns a list of (path, IndexEntry) pairs.
+    """
+    
+    # Find where all the blocks are, and where their data starts
+    block_starts = []
+    block_offsets = []
+    offset = 0
+    for start, data_size in bgzf_blocks(archive_path):
+        block_starts.append(start)
+        block_offsets.append(offset)
+        offset += data_size
+        
+    # Cut the compressed file into roughly equal pieces at block boundaries,
+    # identified by the number of the block they start at.
+    total_size = os.path.getsize(archive_path)
+    cuts = sorted(set([0] + [bisect.bisect_left(block_starts, total_size * i // jobs)
+        for i in range(1, jobs)]))
+    cuts = [cut for cut in cuts if cut < len(block_starts)]
+    
+    shards = []
+    for i, cut in enumerate(cuts):
+        end_offset = block_offsets[cuts[i + 1]] if i + 1 < len(cuts) else None
+        shards.append((archive_path, block_starts[cut] << 16, block_offsets[cut], end_offset))
+        
+    logging.info("Indexing {} shards with {} processes".format(len(shards), jobs))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(index_shard, shards)
+    finally:
+        pool.close()
+        pool.join()
+        
+    # Stitch the shards together, starting from the first header
+    items = []
+    expected = (0, 0)
+    for shard, (header_offset, shard_items, stop) in zip(shards, results):
+        if expected is None:
+            # The archive ended in an earlier shard
+            break
+        end_offset = shard[3]
+        if end_offset is not None and expected[0] >= end_offset:
+            # The previous shard's last member runs right through this one
+            continue
+        if header_offset != expected[0]:
+            # The shard started on data that looked like a header, so redo it
+            # from the header the previous shard stopped at.
+            logging.info("Re-indexing shard from {}".format(expected[0]))
+            shard_items, stop = index_members(archive_path, expected[1], expected[0], end_offset)
+        else:
+            shard_items = [(fields[0], IndexEntry(*fields[1:])) for fields in shard_items]
+        items += shard_items
+        expected = stop
+        
+    return items
+    
+def open_sparse_member(archive_bgzf, entry):
+    """
+    Open the sparse tar member with the given IndexEntry in the given
+    FastBgzfReader with tarfile, which knows how to fill in its holes.
+    
+    Returns the BgzfWrapper the member is read through, and a binary file
+    object for the member's expanded data.
+    """
+    
+    archive_bgzf.seek(entry.virtual_offset)
+    wrapper = BgzfWrapper(archive_bgzf, entry.real_offset)
+    
+    # Start tar read at that position, and take the first member
+    archive_tar = tarfile.TarFile(fileobj=wrapper)
+    return wrapper, archive_tar.extractfile(archive_tar.next())
+    
+def copy_member_data(wrapper, size, out):
+    """
+    Copy the given number of bytes of tar member data from the given
+    BgzfWrapper (or other binary file) to the given binary file, in big
+    chunks.
+    
+    Returns False if the archive ended first.
+    """
+    
+    remaining = size
+    while remaining > 0:
+        chunk = wrapper.read(min(BgzfWrapper.BUFFER_SIZE, remaining))
+        if len(chunk) == 0:
+            return False
+        out.write(chunk)
+        remaining -= len(chunk)
+        
+    return True
+    
 def parse_args(args):
     """
     Takes in the command-line arguments list (args), and returns a nice argparse
@@ -317,6 +1073,11 @@ def parse_args(args):
         help="find the given file or list the given directory in the index")
     parser.add_argument("--extract", type=str, default=None,
         help="extract the given file or directory from the archive")
+    parser.add_argument("--extract-list", type=str, default=None,
+        help="extract the files listed one per line in the given file into the "
+        "current directory")
+    parser.add_argument("--jobs", type=int, default=1,
+        help="number of processes to use when computing the index")
     
     # The command line arguments start with the program name, which we don't
     # want to treat as an argument for argparse. So we remove it.
@@ -340,59 +1101,29 @@ def main(args):
         
         # This will hold IndexEntries for each path in the tar file
         index = Index()
-    
-        # Open the archive
-        archive_bgzf = bgzf.BgzfReader(options.archive_path, "rb")
-        archive_wrapper = BgzfWrapper(archive_bgzf)
-        
-        # Track the BGZF virtual offset of the next TAR record
-        bgzf_offset = archive_bgzf.tell()
-        # And the tar offset
-        tar_offset = archive_wrapper.tell()
-        
-        # Don't actually open the tar file until we get some offsets because it immediately reads the first block
-        archive_tar = tarfile.TarFile(fileobj=archive_wrapper)
-        
-        for info in archive_tar:
-            # Dump each info record
-            logging.info("Got tar info for {}".format(info.name))
-            logging.info("Virtual offset: {} Decompressed offset: {}".format(bgzf_offset, tar_offset))
-            logging.info("tarinfo offset: {} tarinfo data offset: {} tarinfo size: {}".format(info.offset, info.offset_data, info.size))
-            logging.info("tarfile offset: {}".format(archive_tar.offset))
-           
-            # Before we can make a record for this file, we need to know where the next file/EOF is.
-           
-            # archive_tar.offset holds the uncompressed file offset of the *next* entry in the tar file.
-            # Seek there so we can get its bgzf virtual offset.
-            archive_wrapper.seek(archive_tar.offset)
-            logging.info("Manual seek to {} complete".format(archive_tar.offset))
-            
-            # Make an IndexEntry for this file, but which knows the virtual offset of the next file
-            # This means it can define a used byte range in the bgzf file for asynchronous retrieval
-            entry = IndexEntry(bgzf_offset, tar_offset, info.size, archive_bgzf.tell())
+        
+        if options.jobs > 1:
+            # Index pieces of the archive in parallel
+            items = index_parallel(options.archive_path, options.jobs)
+        else:
+            items, _ = index_members(options.archive_path)
             
+        for path, entry in items:
             # Record data in the index
-            index.insert(info.name, entry)
-            
-            # Update offsets for next file
-            bgzf_offset = archive_bgzf.tell()
-            tar_offset = archive_wrapper.tell()
-            
-            # Clear out the members to avoid leaking memory by remembering them all until the file is closed.
-            archive_tar.members = []
+            index.insert(path, entry)
             
         logging.info("Index complete")
         logging.info(index)
         
-        # Save the whole index to a file.
-        # TODO: Allow random access without loading the whole index by saving to a cool binary format.
-        pickle.dump(index, open(options.index_path, 'w'))
+        # Save the whole index to a file, in a binary format that allows random
+        # access without loading the whole index.
+        index.save(options.index_path)
             
     elif options.find is not None:
         # We want to do a list of the given directory.
         
         # Load the index
-        index = pickle.load(open(options.index_path, 'r'))
+        index = PackedIndex(options.index_path)
         
         for basename in index.readdir(options.find):
             # For each child of what we want to list
@@ -412,7 +1143,7 @@ def main(args):
         # We want to extract the given file.
         
         # Load the index
-        index = pickle.load(open(options.index_path, 'r'))
+        index = PackedIndex(options.index_path)
         
         # Find the file to extract
         entry = index.get(options.extract)
@@ -423,24 +1154,117 @@ def main(args):
         # Open the archive and seek.
         # TODO: Request stuff from Glacier and then go get it and trim it,
         # updating the virtual offsets to account for the blocks not present.
-        archive_bgzf = bgzf.BgzfReader(options.archive_path, "rb")
+        archive_bgzf = FastBgzfReader(options.archive_path)
         archive_bgzf.seek(entry.virtual_offset)
         archive_wrapper = BgzfWrapper(archive_bgzf, entry.real_offset)
         
-        # Start tar read at that position
-        archive_tar = tarfile.TarFile(fileobj=archive_wrapper)
-        
-        # Iterate the first tar entry
-        info = next(archive_tar)
-        # And get a file object for its data
-        stream = archive_tar.extractfile(info)
+        # Read past the member's headers ourselves instead of running tarfile
+        header = read_tar_header(archive_wrapper)
         
-        if stream is None:
-            # Not a file, so logging.info nothing
+        if header is None:
+            logging.critical("Archive ended before {}".format(options.extract))
+            return 1
+        if header[2] == tarfile.DIRTYPE:
+            # Not a file, so output nothing
             return
+        if header[2] not in tarfile.REGULAR_TYPES:
+            # Links, devices and FIFOs have no data to output
+            logging.critical("{} is not a plain file".format(options.extract))
+            return 1
         
-        # Dump to standard output
-        shutil.copyfileobj(stream, sys.stdout)
+        data = archive_wrapper
+        if header[2] == tarfile.GNUTYPE_SPARSE:
+            # Sparse files are rare, so let tarfile expand them, from the
+            # start of the member again.
+            archive_wrapper, data = open_sparse_member(archive_bgzf, entry)
+        
+        # Dump exactly the file's data to standard output, as bytes, and stop
+        # there without looking at the next header.
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+        if not copy_member_data(data, entry.size, out):
+            logging.critical("Archive ended in the middle of {}".format(options.extract))
+            return 1
+            
+    elif options.extract_list is not None:
+        # We want to extract all the files listed in the given file.
+        
+        # Load the index
+        index = PackedIndex(options.index_path)
+        
+        # Find all the files to extract before we start
+        to_extract = []
+        with open(options.extract_list) as list_file:
+            for line in list_file:
+                path = line.rstrip("\n")
+                if path == "":
+                    continue
+                if ".." in Index.atomize_path(path):
+                    logging.critical("Refusing to extract {} outside the current directory".format(path))
+                    return 1
+                entry = index.get(path)
+                if entry is None:
+                    logging.critical("{} not found in index".format(path))
+                    return 1
+                to_extract.append((path, entry))
+                
+        # Go through the files in archive order, so we can mostly just move
+        # forward through one reader and keep using its read-ahead.
+        to_extract.sort(key=lambda item: item[1].virtual_offset)
+        
+        archive_bgzf = FastBgzfReader(options.archive_path)
+        archive_wrapper = None
+        # Remember if we had to leave anything out, so we can fail at the end
+        skipped = False
+        
+        for path, entry in to_extract:
+            if (archive_wrapper is not None and
+                0 <= entry.real_offset - archive_wrapper.tell() <= BgzfWrapper.BUFFER_SIZE):
+                # This file is close ahead, so skip to it, mostly through data
+                # we already have.
+                archive_wrapper.seek(entry.real_offset)
+            else:
+                # Jump straight there
+                archive_bgzf.seek(entry.virtual_offset)
+                archive_wrapper = BgzfWrapper(archive_bgzf, entry.real_offset)
+                
+            header = read_tar_header(archive_wrapper)
+            out_path = os.path.join(*Index.atomize_path(path))
+            
+            is_dir = header is not None and header[2] == tarfile.DIRTYPE
+            if not is_dir and (header is None or header[2] not in tarfile.REGULAR_TYPES):
+                logging.warning("Not extracting {}, which is not a plain file".format(path))
+                skipped = True
+                continue
+                
+            # Make the directory, or the one the file goes in
+            out_dir = out_path if is_dir else os.path.dirname(out_path)
+            if out_dir != "" and not os.path.isdir(out_dir):
+                try:
+                    os.makedirs(out_dir)
+                except OSError as e:
+                    # Something is in the way
+                    logging.warning("Not extracting {}: {}".format(path, e))
+                    skipped = True
+                    continue
+            if is_dir:
+                # Directories have no data
+                continue
+                
+            data = archive_wrapper
+            if header[2] == tarfile.GNUTYPE_SPARSE:
+                # Let tarfile expand the rare sparse files, as for --extract
+                archive_wrapper, data = open_sparse_member(archive_bgzf, entry)
+                
+            with open(out_path, "wb") as out:
+                if not copy_member_data(data, entry.size, out):
+                    logging.critical("Archive ended in the middle of {}".format(path))
+                    return 1
+                    
+        archive_bgzf.close()
+        
+        if skipped:
+            logging.critical("Some requested files were not extracted")
+            return 1
 
 def entrypoint():
     """